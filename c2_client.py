@@ -1,23 +1,54 @@
 """A QUIC client that will communicate with the QUIC server."""
 import asyncio
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import os
+import logging
+import pathlib
 from random import randrange
-from typing import cast
+from typing import BinaryIO, Callable, Dict, List, Optional, cast
 
 from aioquic.asyncio import connect
 from aioquic.asyncio.protocol import QuicConnectionProtocol
 from aioquic.h3.connection import H3_ALPN
 from aioquic.quic.configuration import QuicConfiguration
-from aioquic.quic.events import (QuicEvent, StreamDataReceived)
+from aioquic.quic.events import (QuicEvent, StreamDataReceived,
+                                 ConnectionTerminated)
 from aioquic.quic.logger import QuicFileLogger
-from aioquic.quic.stream import QuicStream
 from client.cl_functions import custom_command, stock_command
 
 from client.client_comms import blc
-from tools.constants import (DEFAULT_MAX_DATA, Actions, MAX_VLIE_INT,
-                             DELIMITER, MAX_BYTES)
-from tools.shared_functionality import int_to_enum
+from tools.constants import Actions, MAX_VLIE_INT, DELIMITER_BYTES, MAX_BYTES
+from tools.shared_functionality import (configure_logging,
+                                        install_fast_event_loop, int_to_enum)
+
+# Amount of a file received from the server to collect before writing it to
+# disk (1 MiB).
+_RECV_FLUSH_BYTES = 1 << 20
+
+# File needed for storing QUIC secrets.  Opened once and shared by every
+# QuicClientSetup.
+SECRETS_LOG_FILE = open('secrets_log_file', 'a')
+atexit.register(SECRETS_LOG_FILE.close)
+
+
+def _split_server_data(data: bytes) -> List[str]:
+    """Split data sent by the server (could be used in custom commands, for
+    instance) on the delimiter.
+
+    Args:
+        data (bytes): The data received from the server.
+
+    Returns:
+        List[str]: The non-empty fields, stripped of spaces.
+    """
+    # Split on the raw bytes and only decode the fields that are left after
+    # stripping empty strings and spaces.
+    parts = (p.strip() for p in data.split(DELIMITER_BYTES))
+    server_data = [p.decode('utf-8') for p in parts if p]
+
+    blc.info('Data received:  %s', server_data)
+    return server_data
 
 
 class QuicClientSetup():
@@ -26,20 +57,14 @@ class QuicClientSetup():
     def __init__(self) -> None:
         # A QuicFileLogger is used for tracing events.
         quic_log = 'quic_file_logs'
-        try:
-            os.mkdir(quic_log)
-        except FileExistsError:
-            pass
+        pathlib.Path(quic_log).mkdir(exist_ok=True)
         quic_logger = QuicFileLogger(quic_log)
 
-        # File needed for storing QUIC secrets.
-        secrets_log_file = open('secrets_log_file', 'a')
-
         # A QuicConfiguration object is needed to pass to a QuicConnection.
         self.configuration = QuicConfiguration(
             alpn_protocols=H3_ALPN,
             quic_logger=quic_logger,
-            secrets_log_file=secrets_log_file)
+            secrets_log_file=SECRETS_LOG_FILE)
 
         # Load certificate.
         self.configuration.load_verify_locations(
@@ -59,94 +84,229 @@ class QuicClientProtocol(QuicConnectionProtocol):
         self._quic._local_max_streams_bidi.value = MAX_VLIE_INT
         self._quic._remote_max_streams_bidi = MAX_VLIE_INT
 
+        # Task that streams a file to the server, if one was requested.
+        self._file_task: Optional[asyncio.Task] = None
+        # Files being received from the server, kept open per stream_id
+        # until the server ends the stream.
+        self._recv_files: Dict[int, BinaryIO] = {}
+        # Chunks received for each of those files, written out together once
+        # _RECV_FLUSH_BYTES have built up or the stream ends.
+        self._recv_bufs: Dict[int, bytearray] = {}
+        # Disk I/O is done here rather than on the event loop.  A single
+        # worker keeps the operations on each file in order.
+        self._io_pool = ThreadPoolExecutor(max_workers=1)
+        # Set once the work for this check-in is finished and everything sent
+        # for it has been acknowledged, so the connection can be closed
+        # without waiting out the full check-in interval.
+        self._done = asyncio.Event()
+        # Set once there is work under way that must not be cut off by the
+        # check-in interval (a file upload, or waiting for the last responses
+        # to be acknowledged).
+        self._finishing = False
+        # Task that ends the check-in after the server's last command.
+        self._finish_task: Optional[asyncio.Task] = None
+        # File uploads are read into this one buffer with readinto(), rather
+        # than into a new bytes object for every chunk.  send_stream_data()
+        # copies each chunk before the next read, so it is safe to reuse.
+        self._send_scratch = bytearray(MAX_BYTES)
+        self._send_view = memoryview(self._send_scratch)
+
+        # Handlers for the MAX_DATA values that aren't stock commands.
+        self._dispatch: Dict[int, Callable[[StreamDataReceived], None]] = {
+            Actions.SERVER_FILE_SEND: self._on_file_send,
+            Actions.SERVER_FILE_RECV: self._on_file_recv,
+            Actions.CUSTOM: self._on_custom,
+        }
+
     def quic_event_received(self, event: QuicEvent) -> None:
         """Act upon a QuicEvent that has been received.
 
         Args:
             event (QuicEvent): A QuicEvent instance.
         """
+        # Get the info (most likely a command) from the server.
+        value = self._quic._remote_max_data
         # Check to see if server sent a kill command.
-        if self._quic._remote_max_data == Actions.CLIENT_KILL.value:
+        if value == Actions.CLIENT_KILL:
             # Received a kill.  Exit the client.
             raise KeyboardInterrupt
 
         if isinstance(event, StreamDataReceived):
-            # Get the info (most likely a command) from the server.
-            info = int_to_enum(self._quic._remote_max_data)
-            blc.info(f'Server command is {info.name}')
-
-            # If the server sends a file, this needs to be written to disk
-            # as the frames come in (there will most likely be multiple).
-            if info == Actions.SERVER_FILE_SEND:
-                # TODO: need to get an actual name for the file
-                with open('temp', 'ab') as f:
-                    f.write(event.data)
-                return
-
-            # This is data sent by the server (could be used in custom
-            # commands, for instance).
-            sd_list = event.data.decode('utf-8').strip().split(DELIMITER)
-            # This will strip empty strings and spaces that come from the
-            # split() call above.
-            server_data = [x.strip() for x in sd_list if x]
-
-            blc.info(f'Data received:  {*server_data,}')
-
-            # Server is requesting a file from the client.
-            if info == Actions.SERVER_FILE_RECV:
-                # Only one filename will be sent at a time.
-                filename = server_data[0]
-
-                try:
-                    # Read file contents and send to server.
-                    with open(filename, 'rb') as f:
-                        while True:  # do-while loop
-                            # Need to set this MAX_DATA value for the server.
-                            self._quic._local_max_data.value = Actions.CLIENT_FILE_SEND.value
-                            # Read MAX_BYTES to stuff into QUIC packet.
-                            file_data = f.read(MAX_BYTES)
-                            # break when all of the file is read.
-                            if not file_data:
-                                break
-                            self._quic.send_stream_data(
-                                event.stream_id, file_data)
-
-                except FileNotFoundError:
-                    # Need to set this MAX_DATA value for the server.
-                    self._quic._local_max_data.value = Actions.FILE_NOT_FOUND.value
-                    # Async task for response.
-                    self._quic.send_stream_data(event.stream_id, b'error')
-
-                finally:
-                    return
-
-            # Perform a stock or custom command?  Because of the possibility of
-            # server_data containing more than one command (because of QUIC
-            # packets combined by the library), need to treat both instances as
-            # lists below and process as such just in case.  Will most likely
-            # be just one command though in reality.
-            elif info == Actions.CUSTOM:
-                responses = []
-                for cmd in server_data:
-                    response = custom_command(cmd)
-                    responses.append(response)
-
-            else:
-                # Get the response by running the command.
-                responses = [stock_command(info)]
-
-            for response in responses:
-                # Need to set this MAX_DATA value for the server.
-                self._quic._local_max_data.value = Actions.CLIENT_RESPONSE.value
-
-                # Send data MAX_BYTES at a time.
-                i = 0
-                while True:  # do-while
-                    self._quic.send_stream_data(event.stream_id,
-                                                response[i:i + MAX_BYTES])
-                    i += MAX_BYTES
-                    if i > len(response):
-                        break
+            # Only look up the enum name if it is going to be logged.
+            if blc.isEnabledFor(logging.INFO):
+                blc.info('Server command is %s', int_to_enum(value).name)
+
+            # The server ends the stream after its last command.  This may
+            # arrive on its own, with no command attached; only a file
+            # transfer needs to see that frame.
+            if event.data or value == Actions.SERVER_FILE_SEND:
+                # Anything without its own handler is a stock command.
+                self._dispatch.get(value, self._on_stock)(event)
+
+            if event.end_stream:
+                # The server has sent everything for this check-in; finish up
+                # once it has all of the responses.
+                self._finishing = True
+                self._finish_task = asyncio.create_task(
+                    self._end_check_in(event.stream_id))
+
+        elif isinstance(event, ConnectionTerminated):
+            # Nothing more can be sent on this connection.
+            for task in (self._file_task, self._finish_task):
+                if task is not None:
+                    task.cancel()
+            self._done.set()
+            # Don't leave partially received files open.  Whatever was
+            # received is written out, and queued writes are still completed
+            # before the I/O thread exits.
+            for sid, f in self._recv_files.items():
+                self._io_pool.submit(f.write, self._recv_bufs.pop(sid))
+                self._io_pool.submit(f.close)
+            self._recv_files.clear()
+            self._io_pool.shutdown(wait=False)
+
+    def _on_file_send(self, event: StreamDataReceived) -> None:
+        """The server is sending a file.  This needs to be written to disk
+        as the frames come in (there will most likely be multiple).
+
+        Args:
+            event (StreamDataReceived): A chunk of the file.
+        """
+        sid = event.stream_id
+        f = self._recv_files.get(sid)
+        if f is None:
+            # TODO: need to get an actual name for the file
+            f = self._recv_files[sid] = open('temp_' + str(sid), 'wb')
+        buf = self._recv_bufs.setdefault(sid, bytearray())
+        buf += event.data
+        if len(buf) >= _RECV_FLUSH_BYTES or event.end_stream:
+            # Writes are queued on the single I/O thread, so they land on disk
+            # in the order the chunks arrived.  Hand the buffer over and start
+            # a new one instead of copying it.
+            self._io_pool.submit(f.write, buf)
+            self._recv_bufs[sid] = bytearray()
+        # The server ends the stream after the last chunk.
+        if event.end_stream:
+            del self._recv_bufs[sid]
+            self._io_pool.submit(self._recv_files.pop(sid).close)
+
+    def _on_file_recv(self, event: StreamDataReceived) -> None:
+        """The server is requesting a file from the client.  The file is
+        streamed back by a separate task so the event loop isn't held up while
+        it is read.
+
+        Args:
+            event (StreamDataReceived): The request, holding the filename.
+        """
+        # Only one filename will be sent at a time.
+        filename = _split_server_data(event.data)[0]
+        self._finishing = True
+        self._file_task = asyncio.create_task(
+            self._stream_file(event.stream_id, filename))
+        # _stream_file ends the check-in itself; this only matters if it
+        # fails part way through.
+        self._file_task.add_done_callback(lambda _: self._done.set())
+
+    def _on_custom(self, event: StreamDataReceived) -> None:
+        """Perform custom command(s).  Because of the possibility of the data
+        containing more than one command (because of QUIC packets combined by
+        the library), the commands are treated as a list.  Will most likely be
+        just one command though in reality.  The responses are joined with the
+        delimiter so that they all go out as one payload.
+
+        Args:
+            event (StreamDataReceived): The command(s) from the server.
+        """
+        server_data = _split_server_data(event.data)
+        response = DELIMITER_BYTES.join(
+            custom_command(cmd) for cmd in server_data)
+        self._respond(event.stream_id, response)
+
+    def _on_stock(self, event: StreamDataReceived) -> None:
+        """Perform the stock command given by the server's MAX_DATA value.
+
+        Args:
+            event (StreamDataReceived): The event carrying the command.
+        """
+        # Get the response by running the command.
+        info = int_to_enum(self._quic._remote_max_data)
+        self._respond(event.stream_id, stock_command(info))
+
+    def _respond(self, stream_id: int, response: bytes) -> None:
+        """Send the output of a command to the server.
+
+        Args:
+            stream_id (int): The stream on which to respond.
+            response (bytes): The output of the command(s).
+        """
+        # Need to set this MAX_DATA value for the server.
+        self._quic._local_max_data.value = Actions.CLIENT_RESPONSE
+
+        # Hand over the whole response at once; aioquic splits it into as
+        # many STREAM frames as needed.
+        self._quic.send_stream_data(stream_id, response)
+
+    async def _stream_file(self, stream_id: int, filename: str) -> None:
+        """Send a file requested by the server.  Disk reads run in the
+        protocol's I/O thread so the event loop keeps processing datagrams
+        while the file is read.
+
+        Args:
+            stream_id (int): The stream on which to send the file.
+            filename (str): The name of the file to send.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            f = await loop.run_in_executor(self._io_pool, open, filename, 'rb')
+
+        except FileNotFoundError:
+            # Need to set this MAX_DATA value for the server.
+            self._quic._local_max_data.value = Actions.FILE_NOT_FOUND
+            self._quic.send_stream_data(stream_id, b'error')
+            await self._end_check_in(stream_id)
+            return
+
+        send = self._quic.send_stream_data
+        with f:
+            # Need to set this MAX_DATA value for the server.
+            self._quic._local_max_data.value = Actions.CLIENT_FILE_SEND
+            while True:  # do-while loop
+                # Read up to MAX_BYTES to stuff into QUIC packet.
+                n = await loop.run_in_executor(self._io_pool, f.readinto,
+                                               self._send_scratch)
+                # break when all of the file is read.
+                if not n:
+                    break
+                # aioquic appends the slice to the stream's own buffer right
+                # away, so passing the view needs no copy of its own.  The
+                # cast is only for type checking; send_stream_data is typed
+                # as taking bytes.
+                send(stream_id, cast(bytes, self._send_view[:n]))
+                # Flush now; the next read gives the loop a chance to handle
+                # ACKs so the congestion controller can pace the transfer.
+                self.transmit()
+
+        # The end of the stream tells the server the file is done.
+        await self._end_check_in(stream_id)
+
+    async def _end_check_in(self, stream_id: int) -> None:
+        """End this client's side of the stream, then signal that the
+        check-in is done once the server has acknowledged everything sent on
+        it.  Closing the connection any earlier would throw away whatever the
+        congestion window was still holding back.
+
+        Args:
+            stream_id (int): The stream used for this check-in.
+        """
+        self._quic.send_stream_data(stream_id, b'', end_stream=True)
+        self.transmit()
+
+        # aioquic has no callback for this, so check in on it now and then.
+        # ConnectionTerminated sets _done if the server goes away first.
+        sender = self._quic._streams[stream_id].sender
+        while not sender.is_finished and not self._done.is_set():
+            await asyncio.sleep(0.05)
+        self._done.set()
 
 
 async def perform_connect(quic_client: QuicClientSetup,
@@ -168,33 +328,49 @@ async def perform_connect(quic_client: QuicClientSetup,
             client._quic.close(error_code=stream_id, reason_phrase='terminate')
             return
 
-        blc.debug(f'Checking in at {datetime.now().strftime("%H:%M:%S")}')
+        blc.debug('Checking in at %s', datetime.now().strftime('%H:%M:%S'))
         data = b'Hello!'
 
         # cast is only for type checking.
         client = cast(QuicClientProtocol, client)
 
-        # Create a QuicStream object with custom MAX_DATA values.
-        # max_stream_data values are nominal for this library (i.e.,
-        # these aren't important, just placeholders so API will work).
-        # Stream fails unless these are included!
-        client._quic._streams[stream_id] = QuicStream(
-            stream_id=stream_id,
-            max_stream_data_local=DEFAULT_MAX_DATA,
-            max_stream_data_remote=DEFAULT_MAX_DATA)
-
         # This part arms the sending of the info.
-        client._quic._local_max_data.value = Actions.CLIENT_HELLO.value
-        # Send the message to the server.
+        client._quic._local_max_data.value = Actions.CLIENT_HELLO
+        # Send the message to the server.  aioquic creates the stream on
+        # first use; the very large stream_id is allowed because the server
+        # advertises MAX_VLIE_INT as its bidirectional stream limit.
         client._quic.send_stream_data(stream_id, data)
 
-        # Beware not setting a value high enough here.  Too low will cause the
-        # `quic_event_received()` function above to miss events.
-        # TODO implement sync.  Tried threading locks but no luck.
-        await asyncio.sleep(randrange(6, 9))
+        # Stay connected until the server's commands have been handled.  If
+        # the server has nothing for this client, give up after the usual
+        # randomized check-in interval.
+        try:
+            await asyncio.wait_for(client._done.wait(),
+                                   timeout=randrange(6, 9))
+        except asyncio.TimeoutError:
+            # Don't cut off a file upload, or responses that are still being
+            # delivered.
+            if client._finishing:
+                await client._done.wait()
+
+
+async def check_in_loop(quic_client: QuicClientSetup, stream_id: int) -> None:
+    """Check in with the server until the client is stopped.  Every
+    connection is made from the same event loop.
+
+    Args:
+        quic_client (QuicClientSetup): A QuicClientSetup instance.
+        stream_id (int): The ID to be used by this client as an identifier.
+    """
+    while True:
+        # Connect to the server.
+        await perform_connect(quic_client, stream_id)
 
 
 if __name__ == '__main__':
+    # Only the client's own logger should print anything.
+    configure_logging()
+
     # Create a QuicClientSetup instance and initialize.
     quic_setup = QuicClientSetup()
 
@@ -205,11 +381,14 @@ if __name__ == '__main__':
     # Define this value here so that it is consistent across client runs.
     stream_id = randrange(0, MAX_VLIE_INT, 4)
 
+    # Use uvloop / winloop if available; it cuts the per-datagram overhead
+    # of the event loop.
+    if install_fast_event_loop():
+        blc.debug('Using a libuv-based event loop')
+
     blc.info('QUIC Client is starting...')
     try:
-        while True:
-            # Connect to the server.
-            asyncio.run(perform_connect(quic_setup, stream_id))
+        asyncio.run(check_in_loop(quic_setup, stream_id))
     except KeyboardInterrupt:
         # Yes, here is the stupid way a client must be terminated.  Because
         # the `connect()` function above is actually a context manager, when
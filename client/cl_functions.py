@@ -1,6 +1,8 @@
 """These are the command line functions that can be executed by the client."""
 import logging
+import shlex
 import subprocess
+from typing import Dict, List
 
 from tools.constants import Actions, OS
 
@@ -8,6 +10,47 @@ from tools.constants import Actions, OS
 # a circular import error
 logger = logging.getLogger('__name__')
 
+# The argv used for each "stock" command.  These are executed directly rather
+# than through a shell, which avoids the start-up cost of PowerShell.  Most of
+# them are the same on Windows and Linux (like `whoami`); `pwd` and `ls` are
+# built into cmd.exe on Windows rather than being programs of their own.
+if OS == 'Windows':
+    STOCK_CMD_MAP: Dict[Actions, List[str]] = {
+        Actions.WHOAMI: ['whoami'],
+        Actions.HOSTNAME: ['hostname'],
+        Actions.PWD: ['cmd.exe', '/c', 'cd'],
+        Actions.LS: ['cmd.exe', '/c', 'dir'],
+        Actions.IPCONFIG: ['ipconfig'],
+    }
+elif OS == 'Linux':
+    STOCK_CMD_MAP = {
+        Actions.WHOAMI: ['whoami'],
+        Actions.HOSTNAME: ['hostname'],
+        Actions.PWD: ['pwd'],
+        Actions.LS: ['ls'],
+        Actions.IPCONFIG: ['ip', 'a'],
+    }
+else:
+    STOCK_CMD_MAP = {}
+
+# Characters that need a shell to be interpreted ('=' for variable
+# assignments such as `FOO=bar cmd`).  Custom commands without any of these
+# are executed directly on Linux.
+SHELL_METACHARACTERS = set('|&;<>()$`\\"\'*?[]#~{}=\n')
+
+# POSIX special and regular built-in utilities.  These only exist inside the
+# shell (or behave differently outside of it), so a custom command starting
+# with one of them still goes through /bin/sh.
+SHELL_BUILTINS = frozenset((
+    # Special built-ins.
+    'break', ':', 'continue', '.', 'eval', 'exec', 'exit', 'export',
+    'readonly', 'return', 'set', 'shift', 'times', 'trap', 'unset',
+    # Regular built-ins.
+    'alias', 'bg', 'cd', 'command', 'false', 'fc', 'fg', 'getopts', 'hash',
+    'jobs', 'kill', 'newgrp', 'pwd', 'read', 'true', 'type', 'ulimit',
+    'umask', 'unalias', 'wait',
+))
+
 
 def stock_command(input_cmd: Actions) -> bytes:
     """This function performs "stock" commands that are built into the client.
@@ -19,34 +62,15 @@ def stock_command(input_cmd: Actions) -> bytes:
     Returns:
         bytes: The output from the command.
     """
-    cmd = input_cmd.name.lower()
-
-    # Handle platform-specific commands, if needed.
-    if cmd in ['ipconfig']:
-        print(f'About to handle stock OS-specific command; OS is {OS}')
-        # The functions handled here have different values on Windows and
-        # Linux (not like `whoami` which is the same on both).  A `pass`
-        # statement simply means there's no reason to change the current value.
-        if OS == 'Windows':
-            match cmd:
-                case _:
-                    pass
-        elif OS == 'Linux':
-            match cmd:
-                case 'ipconfig':
-                    cmd = 'ip a'
-                case _:
-                    pass
-        else:
-            raise NotImplementedError('Only handling Windows or Linux commands'
-                                      ' presently!')
+    if not STOCK_CMD_MAP:
+        raise NotImplementedError('Only handling Windows or Linux commands'
+                                  ' presently!')
 
     # Execute the command on the "command line", of sorts.
     print('Execute stock command...')
 
-    # Use PowerShell to support the commands and syntax that will be executed.
-    output = subprocess.run('powershell.exe ' + cmd,
-                            check=True, capture_output=True, shell=True).stdout
+    output = subprocess.run(STOCK_CMD_MAP[input_cmd],
+                            check=True, capture_output=True).stdout
 
     return output
 
@@ -60,18 +84,36 @@ def custom_command(cmd: str) -> bytes:
     Returns:
         bytes: The output from the command.
     """
-    # Logic is the same as above.
     print(f'Execute custom command:  {cmd}')
 
+    if OS == 'Windows':
+        # Custom commands are written for PowerShell.  Start it without a
+        # profile, and without a cmd.exe in front of it.
+        args = ['powershell.exe', '-NoProfile', '-NonInteractive',
+                '-Command', cmd]
+    else:
+        # A plain command line can be executed without a shell.
+        args = shlex.split(cmd) if SHELL_METACHARACTERS.isdisjoint(cmd) else []
+        if not args or args[0] in SHELL_BUILTINS:
+            # Pipes, redirects, built-ins, etc. need the shell to run the
+            # command.
+            args = ['/bin/sh', '-c', cmd]
+
     try:
         # If the process runs correctly, return the stdout of the
         # CompletedProcess object.
-        cp = subprocess.run('powershell.exe ' + cmd,
-                            check=True, capture_output=True, shell=True)
+        cp = subprocess.run(args, check=True, capture_output=True)
         output = cp.stdout
 
     except subprocess.CalledProcessError as e:
         # If an error is returned by the shell, need to return the error text.
-        output = str(e.stderr).encode()
+        # It was captured as bytes already.
+        output = e.stderr if e.stderr is not None else b''
+
+    except OSError as e:
+        # Without a shell, an unknown command means no such program, and a
+        # path that isn't executable can't be run.  Report that rather than
+        # letting it end the check-in.
+        output = str(e).encode()
 
     return output
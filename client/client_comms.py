@@ -1,21 +1,43 @@
 """This module handles communication functionality on the client side."""
 import logging
-import sys
-from typing import Tuple
+from typing import Callable, Dict, Tuple
 
 from client.cl_functions import stock_command, custom_command
 from tools.constants import Actions
 
-
-# Ignore all other loggers from imported modules.
-loggers = [logging.getLogger(name) for name in logging.root.manager.loggerDict]
-for logger in loggers:
-    ql = logging.getLogger(logger.name)
-    ql.disabled = True
 # This base logger can be imported into multiple client modules.
-blc = logging
-blc.basicConfig(stream=sys.stdout, level=logging.DEBUG,
-                format='%(asctime)s %(levelname)s: %(message)s')
+blc = logging.getLogger('quic2.client')
+
+
+# The range of values that encompasses all "stock" commands that can be used
+# for basic data gathering (does not include custom commands sent by the
+# server).
+_STOCK_LO = Actions.WHOAMI
+_STOCK_HI = Actions.NOT_A_VALID_INTEGER - 1
+
+
+def _stock(value: Actions, data: str) -> Tuple[bytes, Actions]:
+    """Execute a stock command."""
+    blc.debug('Prepare to execute stock command')
+    return stock_command(value), Actions.CLIENT_RESPONSE
+
+
+def _custom(value: Actions, data: str) -> Tuple[bytes, Actions]:
+    """Execute a custom command sent by the server."""
+    blc.debug('Prepare to execute custom command')
+    return custom_command(data), Actions.CLIENT_RESPONSE
+
+
+def _no_response(value: Actions, data: str) -> Tuple[bytes, Actions]:
+    """Nothing needs to be done or sent back."""
+    return b'', Actions.NO_RESPONSE_NEEDED
+
+
+# Handlers for the values that are not part of the stock command range.
+_HANDLERS: Dict[int, Callable[[Actions, str], Tuple[bytes, Actions]]] = {
+    Actions.CUSTOM: _custom,
+    Actions.NO_RESPONSE_NEEDED: _no_response,
+}
 
 
 def respond_to_sdr(value: Actions, data: str) -> Tuple[bytes, Actions]:
@@ -30,28 +52,15 @@ def respond_to_sdr(value: Actions, data: str) -> Tuple[bytes, Actions]:
         Actions: Return the appropriate action performed by client.
     """
     if value != Actions.NO_RESPONSE_NEEDED:
-        blc.info(f'Info received:  {value}')
-
-    match value.value:
-        # This range encompasses all "stock" commands that can be used for
-        # basic data gathering (does not include custom commands sent by the
-        # server).
-        case num if (Actions.WHOAMI.value <= num
-                     <= Actions.NOT_A_VALID_INTEGER.value - 1):
-            blc.debug('Prepare to execute stock command')
-            output = stock_command(value)
-            return output, Actions.CLIENT_RESPONSE
-
-        # This value corresponds to executing a custom command.
-        case num if num == Actions.CUSTOM.value:
-            blc.debug('Prepare to execute custom command')
-            output = custom_command(data)
-            return output, Actions.CLIENT_RESPONSE
-
-        case num if num == Actions.NO_RESPONSE_NEEDED.value:
-            return b'', Actions.NO_RESPONSE_NEEDED
-
-        # Something unexpected happened.
-        case _:
-            blc.debug(f'Value is unexpected:  {value.value}.  CLIENT_FAIL')
-            return b'error', Actions.CLIENT_FAIL
+        blc.info('Info received:  %s', value.name)
+
+    handler = _HANDLERS.get(value)
+    if handler is not None:
+        return handler(value, data)
+
+    if _STOCK_LO <= value <= _STOCK_HI:
+        return _stock(value, data)
+
+    # Something unexpected happened.
+    blc.debug('Value is unexpected:  %s.  CLIENT_FAIL', int(value))
+    return b'error', Actions.CLIENT_FAIL
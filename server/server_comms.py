@@ -1,21 +1,85 @@
 """This module handles communication functionality on the server side."""
+import asyncio
 import logging
-import sys
-from typing import Tuple
+from typing import Dict, List, Tuple
 
 from c2_dealer import QuiC2Database
-from tools.constants import Actions
+from tools.constants import Actions, CLIENT_TTL, DELIMITER_BYTES
+from tools.shared_functionality import int_to_enum
 
-
-# Ignore all other loggers from imported modules.
-loggers = [logging.getLogger(name) for name in logging.root.manager.loggerDict]
-for logger in loggers:
-    ql = logging.getLogger(logger.name)
-    ql.disabled = True
 # This base logger can be imported into multiple server modules.
-bls = logging
-bls.basicConfig(stream=sys.stdout, level=logging.DEBUG,
-                format='%(asctime)s %(levelname)s: %(message)s')
+bls = logging.getLogger('quic2.server')
+
+# Timers that remove a client from the database once it has gone CLIENT_TTL
+# seconds without checking in, by stream_id.
+_evict_timers: Dict[int, asyncio.TimerHandle] = {}
+
+
+def _evict(db_con: QuiC2Database, stream_id: int) -> None:
+    """Remove a client that has stopped checking in.
+
+    Args:
+        db_con (QuiC2Database): A connection to the database.
+        stream_id (int): The stream_id of the client.
+    """
+    del _evict_timers[stream_id]
+    if db_con.del_stream_id(stream_id):
+        bls.info('Removed stagnant stream_id: %s', stream_id)
+
+
+def schedule_eviction(db_con: QuiC2Database, stream_id: int) -> None:
+    """(Re)start the timer that removes a client after CLIENT_TTL seconds.
+    Must be called from the running event loop.
+
+    Args:
+        db_con (QuiC2Database): A connection to the database.
+        stream_id (int): The stream_id of the client.
+    """
+    cancel_eviction(stream_id)
+    _evict_timers[stream_id] = asyncio.get_running_loop().call_later(
+        CLIENT_TTL, _evict, db_con, stream_id)
+
+
+def cancel_eviction(stream_id: int) -> None:
+    """Stop the eviction timer for a client, if there is one.
+
+    Args:
+        stream_id (int): The stream_id of the client.
+    """
+    timer = _evict_timers.pop(stream_id, None)
+    if timer is not None:
+        timer.cancel()
+
+
+def _classify_cmds(cmds: List[str]) -> List[Tuple[Actions, bytes]]:
+    """Turn commands from the database into the MAX_DATA value and stream
+    data to send for each, so the sender doesn't have to work it out.
+
+    Args:
+        cmds (List[str]): Commands from the database.
+
+    Returns:
+        List[Tuple[Actions, bytes]]: The Actions to put in the MAX_DATA frame
+            and the data to send with it, for each valid command.
+    """
+    classified: List[Tuple[Actions, bytes]] = []
+    for cmd in cmds:
+        # Only plain ASCII digits; isdigit() alone also accepts characters
+        # like '²' that int() can't parse.
+        if cmd.isascii() and cmd.isdigit():
+            # A stock command is sent via the MAX_DATA frame alone.
+            action = int_to_enum(int(cmd))
+            if action == Actions.NOT_A_VALID_INTEGER:
+                bls.debug('Not a valid Action: %s', cmd)
+                continue
+            classified.append((action, DELIMITER_BYTES))
+        else:
+            # A custom command is sent as bytes.  Use delimiter because QUIC
+            # packet may combine data frames and not distinguish between
+            # commands.
+            classified.append((Actions.CUSTOM, cmd.encode() + DELIMITER_BYTES))
+
+    return classified
 
 
 def respond_to_sdr(db_con: QuiC2Database,
@@ -30,7 +94,8 @@ def respond_to_sdr(db_con: QuiC2Database,
 
     Returns:
         Actions: Return the appropriate response for the client.
-        list: A list of commands for the client to perform.
+        list: For commands, a list of (Actions, bytes) tuples to send to the
+            client.  For file transfers, a list holding the filename.
     """
     # TODO need to actually handle the stream_id values - this may change the
     # response based on whether or not this has been seen, if it's not a
@@ -39,10 +104,12 @@ def respond_to_sdr(db_con: QuiC2Database,
     # Add this stream_id to the database (if it doesn't already exist).
     added = db_con.insert_new_stream_id(stream_id)
     if added:
-        bls.info(f'Add new stream_id {stream_id} to the database')
+        bls.info('Add new stream_id %s to the database', stream_id)
+    # The client is alive, so push back its removal.
+    schedule_eviction(db_con, stream_id)
 
     if value != Actions.CLIENT_HELLO:
-        bls.info(f'{stream_id} info: {value.name}')
+        bls.info('%s info: %s', stream_id, value.name)
 
     # Respond based on the message received.
     match value:
@@ -50,14 +117,16 @@ def respond_to_sdr(db_con: QuiC2Database,
         case Actions.CLIENT_HELLO:
             # Check the database for any commands for this client.
             cmds, error = db_con.sel_and_del_cmd(stream_id)
-            if not error and cmds:
-                bls.debug(f'Client {stream_id} has commands to process')
+            # Work out what to send for each command up front.
+            cmds = _classify_cmds(cmds) if not error else []
+            if cmds:
+                bls.debug('Client %s has commands to process', stream_id)
                 return Actions.SERVER_SEES_HELLO, cmds
 
             # Check the database for any files to send.
             file_send, error = db_con.sel_and_del_file_send(stream_id)
             if not error and file_send:
-                bls.debug(f'Client {stream_id} needs a file transfer')
+                bls.debug('Client %s needs a file transfer', stream_id)
                 # Return as a list to match the type description.  Only one
                 # element will ever be returned.
                 return Actions.SERVER_FILE_SEND, [file_send]
@@ -65,7 +134,7 @@ def respond_to_sdr(db_con: QuiC2Database,
             # Check the database for any files to receive.
             file_recv, error = db_con.sel_and_del_file_recv(stream_id)
             if not error and file_recv:
-                bls.debug(f'Client {stream_id}: server requests file')
+                bls.debug('Client %s: server requests file', stream_id)
                 # Return as a list to match the type description.  Only one
                 # element will ever be returned.
                 return Actions.SERVER_FILE_RECV, [file_recv]
@@ -1,5 +1,5 @@
 """Define constants to be used throughout the program."""
-from enum import Enum
+from enum import IntEnum
 import platform
 
 # This is specified by aioquic as a default in the QuicConfiguration class.
@@ -19,15 +19,22 @@ MAX_VLIE_INT = 107374182000
 # frames.  Necessary because the underlying parts of the API may combine
 # stream frames (which is allowed per RFC 9000), hence combining the data also.
 DELIMITER = '***'
+# The same delimiter, already encoded for sending and splitting stream data.
+DELIMITER_BYTES = b'***'
 
 # Through empirical testing, the maximum number of bytes that could succesfully
 # be stuffed into a single QUIC packet is about 1,230.
 MAX_BYTES = 1230
 
+# Number of seconds a client can go without checking in before the server
+# considers it stagnant and removes it from the database.
+CLIENT_TTL = 60
+
 
 # These are the native actions that can be performed by the client.  Values on
-# the end of the comments are (value x DEFAULT_MAX_DATA) in bytes.
-class Actions(Enum):
+# the end of the comments are (value x DEFAULT_MAX_DATA) in bytes.  Members
+# are ints, so they can be put in a MAX_DATA frame as they are.
+class Actions(IntEnum):
     # Notice that a value of just 1 below isn't possible because that's the
     # default value above...
     CUSTOM = 1153433  # Custom action as given by the server.  1.1
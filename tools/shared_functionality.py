@@ -1,7 +1,15 @@
 """This module houses functions that are used by both clients and servers."""
-from datetime import datetime
+import asyncio
+import logging
+import sys
+import time
+from typing import Dict
 
-from .constants import Actions
+from .constants import Actions, OS
+
+# Map each Actions value to its enum, so that lookups don't have to scan
+# every member.
+_ACTION_BY_VALUE: Dict[int, Actions] = {item: item for item in Actions}
 
 
 def get_now_time() -> float:
@@ -10,12 +18,7 @@ def get_now_time() -> float:
     Returns:
         float: Current UNIX timestamp.
     """
-    # Get the current time.
-    now = datetime.now()
-    # Format to a float.
-    timestamp = datetime.timestamp(now)
-
-    return timestamp
+    return time.time()
 
 
 def int_to_enum(input: int) -> Actions:
@@ -27,12 +30,43 @@ def int_to_enum(input: int) -> Actions:
     Returns:
         Actions: The corresponding enum for the integer.
     """
-    # Check in Actions for a match.
-    for item in Actions:
-        # If there is a match...
-        if input == item.value:
-            # ...return the enum.
-            return item
-
-    # Else return an error.
-    return Actions.NOT_A_VALID_INTEGER
+    # Return the matching enum, else return an error.
+    return _ACTION_BY_VALUE.get(input, Actions.NOT_A_VALID_INTEGER)
+
+
+def configure_logging() -> None:
+    """Set up logging for a client or server.  Call this once, after every
+    module has been imported.
+
+    Loggers belonging to imported modules (aioquic, asyncio, etc.) are
+    disabled so that only the quic2 loggers print anything.
+    """
+    # Ignore all other loggers from imported modules.  loggerDict also holds
+    # placeholders for parents that were never created, so skip those.
+    for logger in logging.root.manager.loggerDict.values():
+        if (isinstance(logger, logging.Logger)
+                and not logger.name.startswith('quic2')):
+            logger.disabled = True
+
+    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s: %(message)s')
+
+
+def install_fast_event_loop() -> bool:
+    """Use a libuv-based event loop (uvloop, or winloop on Windows) for
+    asyncio if one is installed.  Neither is required; the stock event loop
+    is used when they are missing.
+
+    Returns:
+        bool: True if a libuv-based event loop policy was installed.
+    """
+    try:
+        if OS == 'Windows':
+            import winloop as uvloop  # type: ignore[import-not-found]
+        else:
+            import uvloop  # type: ignore[import-not-found]
+    except ImportError:
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True